@@ -1,423 +1,953 @@
-import os
-import time
-import argparse
-import requests
-import pandas as pd
-from dotenv import load_dotenv
-
-# Load environment variables from .env
-load_dotenv()
-
-REQUIRED_ENV = ["SHOPIFY_SHOP", "SHOPIFY_ADMIN_TOKEN", "SHOPIFY_API_VERSION"]
-
-
-def get_env():
-    missing = [k for k in REQUIRED_ENV if not os.environ.get(k, "").strip()]
-    if missing:
-        raise RuntimeError(f"Missing env vars: {', '.join(missing)} in .env")
-
-    shop = os.environ["SHOPIFY_SHOP"].strip()
-    token = os.environ["SHOPIFY_ADMIN_TOKEN"].strip()
-    version = os.environ["SHOPIFY_API_VERSION"].strip()
-    endpoint = f"https://{shop}.myshopify.com/admin/api/{version}/graphql.json"
-    return endpoint, token
-
-
-def graphql_request(query, variables, endpoint, token, max_retries=5):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": token,
-    }
-    payload = {"query": query, "variables": variables}
-
-    backoff = 1
-    for _ in range(max_retries):
-        resp = requests.post(endpoint, json=payload, headers=headers)
-        if resp.status_code == 200:
-            data = resp.json()
-            if "errors" in data:
-                raise RuntimeError(f"GraphQL errors: {data['errors']}")
-            return data["data"]
-
-        if resp.status_code in (429, 500, 502, 503, 504):
-            time.sleep(backoff)
-            backoff = min(backoff * 2, 16)
-            continue
-
-        raise RuntimeError(f"HTTP {resp.status_code}: {resp.text}")
-
-    raise RuntimeError("Max retries exceeded for GraphQL request")
-
-
-def read_products_from_file(path: str, sheet: str | None = None):
-    ext = os.path.splitext(path)[1].lower()
-
-    if ext in (".xlsx", ".xls"):
-        # If no sheet is specified, use the first sheet (index 0)
-        sheet_arg = 0 if sheet is None else sheet
-        df = pd.read_excel(path, sheet_name=sheet_arg)
-    elif ext == ".csv":
-        df = pd.read_csv(path)
-    else:
-        raise ValueError(f"Unsupported file type: {ext}")
-
-    required_cols = [
-        "Handle",
-        "Title",
-        "Body (HTML)",
-        "Type",
-        "Vendor",
-        "Tags",
-        "Variant SKU",
-        "Variant Price",
-        "Option1 Value",
-    ]
-
-    missing = [c for c in required_cols if c not in df.columns]
-    if missing:
-        raise ValueError(f"Missing required columns in file: {', '.join(missing)}")
-
-    df = df.fillna("")
-    return df
-
-
-
-def get_product_by_handle(handle: str, endpoint: str, token: str):
-    query = """
-    query GetProductByHandle($handle: String!) {
-      productByHandle(handle: $handle) {
-        id
-        title
-        handle
-        variants(first: 50) {
-          edges {
-            node {
-              id
-              sku
-              price
-              title
-            }
-          }
-        }
-        images(first: 50) {
-          edges {
-            node {
-              id
-              src
-            }
-          }
-        }
-      }
-    }
-    """
-    vars_ = {"handle": handle}
-    data = graphql_request(query, vars_, endpoint, token)
-    return data.get("productByHandle")
-
-
-
-def build_product_input(row, existing_product=None):
-    tags_str = str(row["Tags"]).strip()
-    tags_list = [t.strip() for t in tags_str.split(",") if t.strip()]
-
-    product_input = {
-        "title": str(row["Title"]).strip(),
-        "handle": str(row["Handle"]).strip(),
-        "descriptionHtml": str(row["Body (HTML)"]).strip(),
-        "productType": str(row["Type"]).strip(),
-        "vendor": str(row["Vendor"]).strip(),
-        "tags": tags_list,
-    }
-
-    if existing_product:
-        product_input["id"] = existing_product["id"]
-
-    return product_input
-
-
-def build_variant_update_input(product: dict, row) -> dict | None:
-    variant_sku = str(row["Variant SKU"]).strip()
-    variant_price = str(row["Variant Price"]).strip()
-
-    edges = product.get("variants", {}).get("edges", [])
-    if not edges:
-        return None
-
-    variant_id = None
-
-    if variant_sku:
-        for edge in edges:
-            node = edge["node"]
-            if node.get("sku") == variant_sku:
-                variant_id = node["id"]
-                break
-
-    if not variant_id:
-        variant_id = edges[0]["node"]["id"]
-
-    # Only use fields allowed in ProductVariantsBulkInput
-    variant_input = {
-        "id": variant_id,
-    }
-
-    if variant_price:
-        variant_input["price"] = str(variant_price)
-
-    if variant_sku:
-        variant_input["sku"] = variant_sku
-
-    return variant_input
-
-
-
-def collect_image_srcs(product: dict | None):
-    srcs = set()
-    if not product:
-        return srcs
-    images = product.get("images", {}).get("edges", [])
-    for edge in images:
-        node = edge["node"]
-        if node.get("src"):
-            srcs.add(node["src"])
-    return srcs
-
-
-def create_product_image(product_id: str, image_src: str, endpoint: str, token: str):
-    query = """
-    mutation productCreateMedia($productId: ID!, $media: [CreateMediaInput!]!) {
-      productCreateMedia(productId: $productId, media: $media) {
-        media {
-          preview {
-            image {
-              url
-            }
-          }
-        }
-        mediaUserErrors {
-          field
-          message
-        }
-      }
-    }
-    """
-
-    variables = {
-        "productId": product_id,
-        "media": [{
-            "originalSource": image_src,
-            "mediaContentType": "IMAGE"
-        }]
-    }
-
-    data = graphql_request(query, variables, endpoint, token)
-    result = data["productCreateMedia"]
-
-    errors = result.get("mediaUserErrors", [])
-    if errors:
-        raise RuntimeError(f"productCreateMedia errors: {errors}")
-
-    return result["media"]
-
-
-def product_create(product_input: dict, endpoint: str, token: str, row, image_src: str | None) -> dict:
-    query = """
-    mutation CreateProduct($input: ProductInput!) {
-      productCreate(input: $input) {
-        product {
-          id
-          title
-          handle
-          variants(first: 20) {
-            edges {
-              node {
-                id
-                sku
-                price
-                title
-              }
-            }
-          }
-          images(first: 20) {
-            edges {
-              node {
-                id
-                src
-              }
-            }
-          }
-        }
-        userErrors {
-          field
-          message
-        }
-      }
-    }
-    """
-    vars_ = {"input": product_input}
-    data = graphql_request(query, vars_, endpoint, token)
-    result = data["productCreate"]
-    errors = result.get("userErrors", [])
-    if errors:
-        raise RuntimeError(f"productCreate errors: {errors}")
-
-    product = result["product"]
-
-    v_input = build_variant_update_input(product, row)
-    if v_input:
-        variant_update(product["id"], v_input, endpoint, token)
-
-
-    if image_src:
-        existing_srcs = collect_image_srcs(product)
-        if image_src not in existing_srcs:
-            create_product_image(product["id"], image_src, endpoint, token)
-
-    return product
-
-
-
-def product_update(product_input: dict, existing_product: dict, endpoint: str, token: str, row, image_src: str | None) -> dict:
-    query = """
-    mutation UpdateProduct($input: ProductInput!) {
-      productUpdate(input: $input) {
-        product {
-          id
-          title
-          handle
-          variants(first: 20) {
-            edges {
-              node {
-                id
-                sku
-                price
-                title
-              }
-            }
-          }
-          images(first: 20) {
-            edges {
-              node {
-                id
-                src
-              }
-            }
-          }
-        }
-        userErrors {
-          field
-          message
-        }
-      }
-    }
-    """
-    vars_ = {"input": product_input}
-    data = graphql_request(query, vars_, endpoint, token)
-    result = data["productUpdate"]
-    errors = result.get("userErrors", [])
-    if errors:
-        raise RuntimeError(f"productUpdate errors: {errors}")
-
-    product = result["product"]
-
-    v_input = build_variant_update_input(product, row)
-    if not v_input and existing_product:
-        v_input = build_variant_update_input(existing_product, row)
-
-    if v_input:
-        # use the product id that matches the variant we built
-        product_id_for_variant = product["id"] if v_input["id"].startswith("gid://shopify/ProductVariant") else existing_product["id"]
-        variant_update(product_id_for_variant, v_input, endpoint, token)
-
-
-    if image_src:
-        existing_srcs = collect_image_srcs(existing_product)
-        existing_srcs.update(collect_image_srcs(product))
-        if image_src not in existing_srcs:
-            create_product_image(product["id"], image_src, endpoint, token)
-
-    return product
-
-
-
-def variant_update(product_id: str, variant_input: dict, endpoint: str, token: str) -> dict:
-    query = """
-    mutation UpdateVariant($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
-      productVariantsBulkUpdate(productId: $productId, variants: $variants) {
-        productVariants {
-          id
-          sku
-          price
-          title
-        }
-        userErrors {
-          field
-          message
-        }
-      }
-    }
-    """
-    vars_ = {
-        "productId": product_id,
-        "variants": [variant_input],
-    }
-    data = graphql_request(query, vars_, endpoint, token)
-    result = data["productVariantsBulkUpdate"]
-    errors = result.get("userErrors", [])
-    if errors:
-        raise RuntimeError(f"productVariantsBulkUpdate errors: {errors}")
-    # we only updated one variant, so return the first
-    return result["productVariants"][0]
-
-
-
-def process_row(row, endpoint, token, dry_run=False):
-    handle = str(row["Handle"]).strip()
-    if not handle:
-        raise ValueError("Each row must have a 'Handle' value")
-
-    image_src = str(row.get("Image Src", "")).strip()
-
-    existing = get_product_by_handle(handle, endpoint, token)
-    product_input = build_product_input(row, existing_product=existing)
-
-    if dry_run:
-        action = "update" if existing else "create"
-        extra = " + image" if image_src else ""
-        print(f"[DRY-RUN] Would {action} product '{product_input['title']}' ({handle}){extra}")
-        return
-
-    if existing:
-        p = product_update(product_input, existing, endpoint, token, row, image_src)
-        print(f"Updated product: {p['title']} ({p['id']})")
-    else:
-        p = product_create(product_input, endpoint, token, row, image_src)
-        print(f"Created product: {p['title']} ({p['id']})")
-
-
-
-def main():
-    parser = argparse.ArgumentParser(
-        description="Import/update Shopify products from Excel/CSV via GraphQL Admin API."
-    )
-    parser.add_argument("file_path", help="Path to .xlsx or .csv file")
-    parser.add_argument("--sheet", help="Sheet name (for Excel)", default=None)
-    parser.add_argument(
-        "--dry-run",
-        action="store_true",
-        help="Just print what would be done, without calling Shopify",
-    )
-    args = parser.parse_args()
-
-    endpoint, token = get_env()
-    df = read_products_from_file(args.file_path, args.sheet)
-
-    for idx, row in df.iterrows():
-        try:
-            process_row(row, endpoint, token, dry_run=args.dry_run)
-        except Exception as e:
-            print(f"Row {idx} failed: {e}")
-
-
-if __name__ == "__main__":
-    main()
-
+import os
+import time
+import random
+import argparse
+import itertools
+import mimetypes
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import openpyxl
+import requests
+import pandas as pd
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# Load environment variables from .env
+load_dotenv()
+
+# Shared session so TLS connections are kept alive and reused across all
+# GraphQL calls (and across worker threads — urllib3's pool is thread-safe).
+# Retries stay in graphql_request, so the adapter itself does none.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(max_retries=0, pool_connections=16, pool_maxsize=32),
+)
+
+# (connect, read) timeouts so a stuck request cannot hang a worker forever
+REQUEST_TIMEOUT = (5, 30)
+
+REQUIRED_ENV = ["SHOPIFY_SHOP", "SHOPIFY_ADMIN_TOKEN", "SHOPIFY_API_VERSION"]
+
+# How many product lookups to merge into one aliased GraphQL query
+LOOKUP_BATCH_SIZE = 25
+
+# How many input rows to materialize at a time while streaming the file
+READ_CHUNK_SIZE = 2048
+
+# How many rows to process concurrently; the work is network-bound, so
+# threads spend almost all their time waiting on Shopify with the GIL released
+MAX_WORKERS = 8
+
+# Products already fetched or written during this run, keyed by handle.
+# None means "looked up, does not exist". Avoids re-fetching when the same
+# handle appears on multiple input rows (e.g. variants-as-rows exports).
+# Plain dict get/set are atomic under the GIL, so worker threads share it.
+_HANDLE_CACHE: dict[str, dict | None] = {}
+
+# Source image URL -> staged CDN resourceUrl, filled by stage_image_uploads.
+# Sources missing from the map fall back to Shopify-side remote fetch.
+_STAGED_URLS: dict[str, str] = {}
+
+# (product id, normalized image URL) pairs already attached this run, so
+# repeated rows for the same product never re-send the same file
+_SEEN_IMAGES: set[tuple[str, str]] = set()
+
+
+def get_env():
+    missing = [k for k in REQUIRED_ENV if not os.environ.get(k, "").strip()]
+    if missing:
+        raise RuntimeError(f"Missing env vars: {', '.join(missing)} in .env")
+
+    shop = os.environ["SHOPIFY_SHOP"].strip()
+    token = os.environ["SHOPIFY_ADMIN_TOKEN"].strip()
+    version = os.environ["SHOPIFY_API_VERSION"].strip()
+    endpoint = f"https://{shop}.myshopify.com/admin/api/{version}/graphql.json"
+    return endpoint, token
+
+
+def _retry_sleep_seconds(resp, backoff):
+    """How long to sleep before retrying a failed request.
+
+    Prefers the server's Retry-After header (Shopify sends it on 429s);
+    otherwise uses exponential backoff with randomized jitter so that
+    concurrent workers don't all retry at the same instant.
+    """
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0.5, 1.5) * min(backoff, 16)
+
+
+def _throttle_if_near_limit(body: dict):
+    """Pre-sleep when the response says the cost budget is nearly spent.
+
+    The GraphQL Admin API reports throttle state in the response body under
+    extensions.cost.throttleStatus (the X-Shopify-Shop-Api-Call-Limit header
+    belongs to the REST API and is never sent here). Slowing down when less
+    than 20% of the budget remains spreads requests out instead of spiking
+    into THROTTLED errors.
+    """
+    throttle = (
+        (body.get("extensions") or {}).get("cost", {}).get("throttleStatus") or {}
+    )
+    maximum = throttle.get("maximumAvailable") or 0
+    available = throttle.get("currentlyAvailable")
+    if maximum and available is not None and available / maximum < 0.2:
+        time.sleep(0.5)
+
+
+def graphql_request(query, variables, endpoint, token, max_retries=5):
+    headers = {
+        "Content-Type": "application/json",
+        "X-Shopify-Access-Token": token,
+    }
+    # orjson serializes/parses a few times faster than stdlib json, which
+    # adds up over the large mutation responses of a big import
+    payload = orjson.dumps({"query": query, "variables": variables})
+
+    backoff = 1
+    for _ in range(max_retries):
+        resp = _SESSION.post(endpoint, data=payload, headers=headers, timeout=REQUEST_TIMEOUT)
+        if resp.status_code == 200:
+            body = orjson.loads(resp.content)
+            _throttle_if_near_limit(body)
+            if "errors" in body:
+                raise RuntimeError(f"GraphQL errors: {body['errors']}")
+            return body["data"]
+
+        if resp.status_code in (429, 500, 502, 503, 504):
+            time.sleep(_retry_sleep_seconds(resp, backoff))
+            backoff = min(backoff * 2, 16)
+            continue
+
+        raise RuntimeError(f"HTTP {resp.status_code}: {resp.text}")
+
+    raise RuntimeError("Max retries exceeded for GraphQL request")
+
+
+REQUIRED_COLS = [
+    "Handle",
+    "Title",
+    "Body (HTML)",
+    "Type",
+    "Vendor",
+    "Tags",
+    "Variant SKU",
+    "Variant Price",
+    "Option1 Value",
+]
+
+
+def _check_required_columns(columns):
+    missing = [c for c in REQUIRED_COLS if c not in columns]
+    if missing:
+        raise ValueError(f"Missing required columns in file: {', '.join(missing)}")
+
+
+def _iter_chunks(path: str, sheet: str | None = None):
+    """Yield the input file as DataFrame chunks of READ_CHUNK_SIZE rows.
+
+    CSVs stream via pandas' chunked reader; .xlsx streams via openpyxl's
+    read-only mode, so peak memory stays proportional to one chunk rather
+    than the whole file.
+
+    All cell values are read as plain `str` (empty string for blanks), so
+    downstream code never has to coerce NaN/numpy scalars per field.
+    """
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == ".csv":
+        yield from pd.read_csv(
+            path,
+            chunksize=READ_CHUNK_SIZE,
+            dtype=str,
+            keep_default_na=False,
+            na_filter=False,
+        )
+    elif ext == ".xlsx":
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb[sheet] if sheet is not None else wb[wb.sheetnames[0]]
+            rows = ws.iter_rows(values_only=True)
+            headers = [str(h) if h is not None else "" for h in next(rows, ())]
+            width = len(headers)
+            buf = []
+            for row in rows:
+                # Read-only rows can be short when trailing cells are empty
+                cells = [("" if v is None else str(v)) for v in row]
+                buf.append((cells + [""] * width)[:width])
+                if len(buf) >= READ_CHUNK_SIZE:
+                    yield pd.DataFrame(buf, columns=headers)
+                    buf = []
+            if buf:
+                yield pd.DataFrame(buf, columns=headers)
+        finally:
+            wb.close()
+    elif ext == ".xls":
+        # Legacy format: no streaming reader available, load in one go
+        sheet_arg = 0 if sheet is None else sheet
+        yield pd.read_excel(path, sheet_name=sheet_arg, dtype=str).fillna("")
+    else:
+        raise ValueError(f"Unsupported file type: {ext}")
+
+
+def _validate_chunk(chunk, offset: int):
+    """Drop invalid rows in bulk before any network work happens.
+
+    A blank Handle or non-numeric Variant Price would otherwise only fail
+    after a GraphQL round trip (and occupy retry/backoff budget); checking
+    the whole chunk with vectorized ops costs no API calls at all.
+    """
+    handles = chunk["Handle"].str.strip()
+    prices = chunk["Variant Price"].str.strip()
+    ok = (handles != "") & (
+        (prices == "") | pd.to_numeric(prices, errors="coerce").notna()
+    )
+
+    bad = (~ok).to_numpy().nonzero()[0]
+    for i in bad:
+        if handles.iloc[i] == "":
+            reason = "missing 'Handle' value"
+        else:
+            reason = f"invalid 'Variant Price': {chunk['Variant Price'].iloc[i]!r}"
+        print(f"Row {offset + i} skipped: {reason}")
+
+    return chunk.loc[ok]
+
+
+def _prepare_chunk(chunk):
+    """Per-chunk column work that would otherwise run per row in Python.
+
+    Tags are split/stripped once here with pandas string ops, so
+    build_product_input just picks up the ready-made list.
+    """
+    chunk["_tags_list"] = (
+        chunk["Tags"]
+        .str.split(",")
+        .apply(lambda parts: [t.strip() for t in parts if t.strip()])
+    )
+    return chunk
+
+
+def iter_product_rows(path: str, sheet: str | None = None):
+    """Stream the input file as row dicts without loading it all into memory."""
+    first = True
+    offset = 0
+    for chunk in _iter_chunks(path, sheet):
+        if first:
+            _check_required_columns(chunk.columns)
+            first = False
+        n = len(chunk)
+        chunk = chunk.reset_index(drop=True)
+        # Absolute input-row index, assigned before validation drops rows so
+        # "Row N skipped" and "Row N failed" agree on which row N is
+        chunk["_row"] = chunk.index + offset
+        chunk = _validate_chunk(chunk, offset).copy()
+        offset += n
+        yield from _prepare_chunk(chunk).to_dict("records")
+
+
+
+# Field selection shared by the lookups and mutation responses; the
+# variants/media window sizes are parameters because the aliased batch
+# lookup needs much smaller ones (see BATCH_PRODUCT_FIELDS)
+_PRODUCT_FIELDS_TEMPLATE = """
+        id
+        title
+        handle
+        descriptionHtml
+        productType
+        vendor
+        tags
+        variants(first: %(variants)d) {
+          edges {
+            node {
+              id
+              sku
+              price
+              title
+              selectedOptions {
+                name
+                value
+              }
+            }
+          }
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+        }
+        media(first: %(media)d) {
+          edges {
+            node {
+              id
+              mediaContentType
+              ... on MediaImage {
+                image {
+                  url
+                }
+              }
+            }
+          }
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+        }
+"""
+
+PRODUCT_FIELDS = _PRODUCT_FIELDS_TEMPLATE % {"variants": 100, "media": 250}
+
+# Shopify prices a query by its requested cost before executing it, and the
+# batched lookup multiplies the selection cost by LOOKUP_BATCH_SIZE aliases.
+# With the full windows that blows past the cost bucket and the whole query
+# is rejected, so the batch uses small windows (~25 points per alias, ~600
+# for a full batch) and _paginate_connection completes the rare product
+# that overflows them.
+BATCH_PRODUCT_FIELDS = _PRODUCT_FIELDS_TEMPLATE % {"variants": 10, "media": 10}
+
+
+# Query/mutation documents are static, so build them once at import time
+# instead of re-assembling the strings on every call. graphql_request embeds
+# them in the JSON payload, so there is nothing else to pre-encode per call.
+_Q_GET_PRODUCT = """
+    query GetProductByHandle($handle: String!) {
+      productByHandle(handle: $handle) {%s}
+    }
+    """ % PRODUCT_FIELDS
+
+_Q_PRODUCT_SET = """
+    mutation SetProduct($input: ProductSetInput!, $synchronous: Boolean!) {
+      productSet(input: $input, synchronous: $synchronous) {
+        product {%s}
+        userErrors {
+          field
+          message
+        }
+      }
+    }
+    """ % PRODUCT_FIELDS
+
+_Q_STAGED_UPLOADS = """
+    mutation StagedUploads($input: [StagedUploadInput!]!) {
+      stagedUploadsCreate(input: $input) {
+        stagedTargets {
+          url
+          resourceUrl
+          parameters {
+            name
+            value
+          }
+        }
+        userErrors {
+          field
+          message
+        }
+      }
+    }
+    """
+
+
+# Follow-up pages for products whose variants/media exceed the first window
+_Q_VARIANTS_PAGE = """
+    query ProductVariantsPage($id: ID!, $after: String!) {
+      product(id: $id) {
+        variants(first: 100, after: $after) {
+          edges {
+            node {
+              id
+              sku
+              price
+              title
+              selectedOptions {
+                name
+                value
+              }
+            }
+          }
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+        }
+      }
+    }
+    """
+
+_Q_MEDIA_PAGE = """
+    query ProductMediaPage($id: ID!, $after: String!) {
+      product(id: $id) {
+        media(first: 250, after: $after) {
+          edges {
+            node {
+              id
+              mediaContentType
+              ... on MediaImage {
+                image {
+                  url
+                }
+              }
+            }
+          }
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+        }
+      }
+    }
+    """
+
+
+def get_product_by_handle(handle: str, endpoint: str, token: str):
+    if handle in _HANDLE_CACHE:
+        return _HANDLE_CACHE[handle]
+
+    vars_ = {"handle": handle}
+    data = graphql_request(_Q_GET_PRODUCT, vars_, endpoint, token)
+    product = _ingest_product(data.get("productByHandle"), endpoint, token)
+    _HANDLE_CACHE[handle] = product
+    return product
+
+
+def get_products_by_handles(handles: list[str], endpoint: str, token: str) -> dict:
+    """Look up many products in a single request via GraphQL aliasing.
+
+    Builds one query with an aliased `productByHandle` field per handle, so a
+    batch of N lookups costs one HTTPS round trip instead of N. Returns a dict
+    mapping each handle to its product (or None if it does not exist).
+    """
+    misses = [h for h in handles if h not in _HANDLE_CACHE]
+    if misses:
+        var_defs = []
+        selections = []
+        variables = {}
+        for i, handle in enumerate(misses):
+            var_defs.append(f"$h{i}: String!")
+            selections.append(f"p{i}: productByHandle(handle: $h{i}) {{{BATCH_PRODUCT_FIELDS}}}")
+            variables[f"h{i}"] = handle
+
+        query = "query GetProductsByHandles(%s) {\n%s\n}" % (
+            ", ".join(var_defs),
+            "\n".join(selections),
+        )
+        data = graphql_request(query, variables, endpoint, token)
+        for i, handle in enumerate(misses):
+            _HANDLE_CACHE[handle] = _ingest_product(data.get(f"p{i}"), endpoint, token)
+
+    return {handle: _HANDLE_CACHE[handle] for handle in handles}
+
+
+
+def build_product_input(row: dict, existing_product: dict | None = None) -> dict:
+    product_input = {
+        "title": row["Title"].strip(),
+        "handle": row["Handle"].strip(),
+        "descriptionHtml": row["Body (HTML)"].strip(),
+        "productType": row["Type"].strip(),
+        "vendor": row["Vendor"].strip(),
+        # Pre-split per chunk in _prepare_chunk
+        "tags": row["_tags_list"],
+    }
+
+    if existing_product:
+        product_input["id"] = existing_product["id"]
+
+    return product_input
+
+
+def _variant_option_values(node: dict) -> list[dict]:
+    option_values = [
+        {"optionName": opt["name"], "name": opt["value"]}
+        for opt in node.get("selectedOptions") or []
+    ]
+    if not option_values:
+        option_values = [
+            {"optionName": "Title", "name": node.get("title") or "Default Title"}
+        ]
+    return option_values
+
+
+def build_product_set_input(
+    base_input: dict,
+    row: dict,
+    existing: dict | None,
+    variant_input: dict | None,
+    image_src: str | None,
+) -> dict:
+    """Assemble the ProductSetInput for one row.
+
+    productSet is declarative for any list it receives: variants or files
+    left out of a provided list are removed from the product, while omitting
+    the field entirely leaves it untouched. So the variants list restates
+    every existing variant (with the row's sku/price applied to the matched
+    one) and the files list restates existing media by id; either field is
+    omitted when that part of the product needs no change.
+    """
+    set_input = dict(base_input)
+
+    if existing is None:
+        # New product: single variant straight from the row
+        variant_sku = row["Variant SKU"].strip()
+        variant_price = row["Variant Price"].strip()
+        option1_value = row["Option1 Value"].strip() or "Default Title"
+
+        variant = {"optionValues": [{"optionName": "Title", "name": option1_value}]}
+        if variant_price:
+            variant["price"] = variant_price
+        if variant_sku:
+            variant["sku"] = variant_sku
+
+        set_input["productOptions"] = [
+            {"name": "Title", "values": [{"name": option1_value}]}
+        ]
+        set_input["variants"] = [variant]
+
+        if image_src:
+            set_input["files"] = [
+                {
+                    "originalSource": _STAGED_URLS.get(image_src, image_src),
+                    "contentType": "IMAGE",
+                }
+            ]
+        return set_input
+
+    if variant_input:
+        variants = []
+        option_values: dict[str, dict] = {}
+        for edge in existing.get("variants", {}).get("edges", []):
+            node = edge["node"]
+            ovs = _variant_option_values(node)
+            variant = {"optionValues": ovs}
+            if node.get("sku"):
+                variant["sku"] = node["sku"]
+            if node.get("price"):
+                variant["price"] = node["price"]
+            if node["id"] == variant_input["id"]:
+                if "price" in variant_input:
+                    variant["price"] = variant_input["price"]
+                if "sku" in variant_input:
+                    variant["sku"] = variant_input["sku"]
+            variants.append(variant)
+            for ov in ovs:
+                option_values.setdefault(ov["optionName"], {})[ov["name"]] = None
+
+        set_input["variants"] = variants
+        set_input["productOptions"] = [
+            {"name": name, "values": [{"name": value} for value in values]}
+            for name, values in option_values.items()
+        ]
+
+    if image_src:
+        # Restate from the media connection, not images: the files list is
+        # declarative over ALL media (videos and models included), and
+        # FileSetInput.id expects File gids, which ProductImage ids are not
+        files: list[dict] = [
+            {"id": edge["node"]["id"]}
+            for edge in existing.get("media", {}).get("edges", [])
+            if edge["node"].get("id")
+        ]
+        files.append(
+            {
+                "originalSource": _STAGED_URLS.get(image_src, image_src),
+                "contentType": "IMAGE",
+            }
+        )
+        set_input["files"] = files
+
+    return set_input
+
+
+def build_variant_update_input(product: dict, row: dict) -> dict | None:
+    variant_sku = row["Variant SKU"].strip()
+    variant_price = row["Variant Price"].strip()
+
+    edges = product.get("variants", {}).get("edges", [])
+    if not edges:
+        return None
+
+    variant_id = None
+
+    if variant_sku:
+        # O(1) via the index attached at ingestion time
+        variant_id = _attach_variant_index(product)["_variant_by_sku"].get(variant_sku)
+
+    if not variant_id:
+        variant_id = edges[0]["node"]["id"]
+
+    # Only use fields allowed in ProductVariantsBulkInput
+    variant_input = {
+        "id": variant_id,
+    }
+
+    if variant_price:
+        variant_input["price"] = str(variant_price)
+
+    if variant_sku:
+        variant_input["sku"] = variant_sku
+
+    return variant_input
+
+
+
+def product_fields_unchanged(product_input: dict, existing: dict) -> bool:
+    """True when productUpdate would be a no-op for the product-level fields.
+
+    On re-runs of the same file most rows change nothing, so skipping the
+    mutation saves the round trip entirely.
+    """
+    return (
+        product_input["title"] == (existing.get("title") or "")
+        and product_input["descriptionHtml"] == (existing.get("descriptionHtml") or "")
+        and product_input["productType"] == (existing.get("productType") or "")
+        and product_input["vendor"] == (existing.get("vendor") or "")
+        and set(product_input["tags"]) == set(existing.get("tags") or [])
+    )
+
+
+def variant_unchanged(product: dict, variant_input: dict) -> bool:
+    """True when the targeted variant already has the requested sku/price."""
+    for edge in product.get("variants", {}).get("edges", []):
+        node = edge["node"]
+        if node["id"] != variant_input["id"]:
+            continue
+        if "sku" in variant_input and variant_input["sku"] != (node.get("sku") or ""):
+            return False
+        if "price" in variant_input:
+            # Shopify returns prices like "299.00"; compare numerically
+            try:
+                if float(variant_input["price"]) != float(node.get("price") or 0):
+                    return False
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def _paginate_connection(product: dict, field: str, page_query: str, endpoint: str, token: str):
+    """Pull the remaining pages of a variants/media connection, if any.
+
+    The fixed first: windows silently truncate large products; a truncated
+    image list makes the dedupe check miss existing media and re-create it,
+    wasting a mutation per re-run. Cursor pagination only fires when
+    pageInfo says there is actually more data.
+    """
+    conn = product.get(field) or {}
+    page_info = conn.get("pageInfo") or {}
+    while page_info.get("hasNextPage"):
+        vars_ = {"id": product["id"], "after": page_info["endCursor"]}
+        data = graphql_request(page_query, vars_, endpoint, token)
+        page = (data.get("product") or {}).get(field) or {}
+        conn.setdefault("edges", []).extend(page.get("edges", []))
+        page_info = page.get("pageInfo") or {}
+    if "pageInfo" in conn:
+        conn["pageInfo"] = page_info
+
+
+def _ingest_product(product: dict | None, endpoint: str, token: str) -> dict | None:
+    """Complete and index a product dict fresh from the API."""
+    if product is None:
+        return None
+    _paginate_connection(product, "variants", _Q_VARIANTS_PAGE, endpoint, token)
+    _paginate_connection(product, "media", _Q_MEDIA_PAGE, endpoint, token)
+    _attach_variant_index(product)
+    return _attach_image_srcs(product)
+
+
+def _attach_variant_index(product: dict | None) -> dict | None:
+    """Precompute a sku -> variant id map stored on the product dict.
+
+    Replaces the linear edge scan in build_variant_update_input, which is
+    O(variants) per row and re-runs for every row targeting the same product.
+    """
+    if product is not None and "_variant_by_sku" not in product:
+        product["_variant_by_sku"] = {
+            (edge["node"].get("sku") or ""): edge["node"]["id"]
+            for edge in product.get("variants", {}).get("edges", [])
+        }
+    return product
+
+
+def _norm_image_url(url: str) -> str:
+    """Normalize an image URL for duplicate comparison.
+
+    A trailing slash, query string (e.g. CDN cache-busters) or case
+    difference in the host would otherwise defeat the dedupe check and
+    trigger a redundant upload on re-runs. Only the host is lowercased;
+    paths are case-sensitive on most CDNs.
+    """
+    parts = urlsplit(url)
+    return (
+        parts._replace(netloc=parts.netloc.lower(), query="", fragment="")
+        .geturl()
+        .rstrip("/")
+    )
+
+
+def _attach_image_srcs(product: dict | None) -> dict | None:
+    """Precompute the product's image srcs as a frozenset stored on the dict.
+
+    Done once wherever a product enters the process (lookup or mutation
+    response), so membership checks are O(1) and nothing rebuilds the set
+    per row. Srcs are normalized; compare against _norm_image_url output.
+    Frozen so callers can't accidentally mutate the shared copy.
+    """
+    if product is not None and "_image_srcs" not in product:
+        srcs = []
+        for edge in product.get("media", {}).get("edges", []):
+            image = edge["node"].get("image") or {}
+            if image.get("url"):
+                srcs.append(_norm_image_url(image["url"]))
+        product["_image_srcs"] = frozenset(srcs)
+    return product
+
+
+def collect_image_srcs(product: dict | None):
+    if not product:
+        return frozenset()
+    return _attach_image_srcs(product)["_image_srcs"]
+
+
+def _stage_one(src: str, target: dict):
+    # Buffer the image so the PUT carries a Content-Length: an unsized
+    # stream makes requests fall back to chunked transfer encoding, which
+    # the signed upload URLs reject. Images are small enough that one
+    # in-memory copy per worker thread is fine.
+    headers = {p["name"]: p["value"] for p in target.get("parameters", [])}
+    resp = _SESSION.get(src, timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+    put = _SESSION.put(
+        target["url"], data=resp.content, headers=headers, timeout=REQUEST_TIMEOUT
+    )
+    put.raise_for_status()
+    _STAGED_URLS[src] = target["resourceUrl"]
+
+
+def stage_image_uploads(srcs: list[str], endpoint: str, token: str, ex: ThreadPoolExecutor):
+    """Pre-upload source images to Shopify's CDN via stagedUploadsCreate.
+
+    Passing a remote URL as originalSource makes Shopify fetch it server-side
+    behind a serialized queue; staging moves the transfer to our side, where
+    the PUTs run concurrently, and productSet then ingests straight from the
+    CDN. One stagedUploadsCreate call covers the whole batch (the input is a
+    list). Any failure falls back to the original URL, which behaves exactly
+    as before.
+    """
+    todo = [s for s in srcs if s and s not in _STAGED_URLS]
+    if not todo:
+        return
+
+    inputs = []
+    for src in todo:
+        filename = os.path.basename(urlsplit(src).path) or "image"
+        mime = mimetypes.guess_type(filename)[0] or "image/jpeg"
+        inputs.append(
+            {
+                "resource": "IMAGE",
+                "filename": filename,
+                "mimeType": mime,
+                "httpMethod": "PUT",
+            }
+        )
+
+    try:
+        data = graphql_request(_Q_STAGED_UPLOADS, {"input": inputs}, endpoint, token)
+        result = data["stagedUploadsCreate"]
+        errors = result.get("userErrors", [])
+        if errors:
+            raise RuntimeError(f"stagedUploadsCreate errors: {errors}")
+        targets = result["stagedTargets"]
+    except Exception as e:
+        print(f"Staged uploads unavailable ({e}); falling back to remote fetch")
+        return
+
+    def upload(pair):
+        src, target = pair
+        try:
+            _stage_one(src, target)
+        except Exception as e:
+            print(f"Staged upload failed for {src}: {e}")
+
+    list(ex.map(upload, zip(todo, targets)))
+
+
+def product_set(set_input: dict, endpoint: str, token: str) -> dict:
+    """Upsert product fields, variants and media in one atomic mutation."""
+    vars_ = {"input": set_input, "synchronous": True}
+    data = graphql_request(_Q_PRODUCT_SET, vars_, endpoint, token)
+    result = data["productSet"]
+    errors = result.get("userErrors", [])
+    if errors:
+        raise RuntimeError(f"productSet errors: {errors}")
+
+    product = _ingest_product(result["product"], endpoint, token)
+    _HANDLE_CACHE[product["handle"]] = product
+    return product
+
+
+def process_row(row: dict, existing: dict | None, endpoint: str, token: str, dry_run: bool = False):
+    handle = row["Handle"].strip()
+    if not handle:
+        raise ValueError("Each row must have a 'Handle' value")
+
+    image_src = row.get("Image Src", "").strip()
+
+    product_input = build_product_input(row, existing_product=existing)
+
+    if dry_run:
+        action = "update" if existing else "create"
+        extra = " + image" if image_src else ""
+        print(f"[DRY-RUN] Would {action} product '{product_input['title']}' ({handle}){extra}")
+        return
+
+    norm_src = _norm_image_url(image_src) if image_src else ""
+
+    if existing:
+        v_input = build_variant_update_input(existing, row)
+        variant_changed = bool(v_input) and not variant_unchanged(existing, v_input)
+        image_missing = (
+            bool(image_src)
+            and norm_src not in collect_image_srcs(existing)
+            and (existing["id"], norm_src) not in _SEEN_IMAGES
+        )
+        fields_changed = not product_fields_unchanged(product_input, existing)
+
+        if not (fields_changed or variant_changed or image_missing):
+            print(f"Unchanged product: {existing['title']} ({existing['id']})")
+            return
+
+        set_input = build_product_set_input(
+            product_input,
+            row,
+            existing,
+            v_input if variant_changed else None,
+            image_src if image_missing else None,
+        )
+        p = product_set(set_input, endpoint, token)
+        if image_missing:
+            _SEEN_IMAGES.add((p["id"], norm_src))
+        print(f"Updated product: {p['title']} ({p['id']})")
+    else:
+        set_input = build_product_set_input(
+            product_input, row, None, None, image_src or None
+        )
+        p = product_set(set_input, endpoint, token)
+        if image_src:
+            _SEEN_IMAGES.add((p["id"], norm_src))
+        print(f"Created product: {p['title']} ({p['id']})")
+
+
+def _safe_process(idx, row, existing, endpoint, token, dry_run):
+    # Keep row-level failure isolation when rows run on worker threads
+    try:
+        process_row(row, existing, endpoint, token, dry_run=dry_run)
+    except Exception as e:
+        print(f"Row {idx} failed: {e}")
+
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import/update Shopify products from Excel/CSV via GraphQL Admin API."
+    )
+    parser.add_argument("file_path", help="Path to .xlsx or .csv file")
+    parser.add_argument("--sheet", help="Sheet name (for Excel)", default=None)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Just print what would be done, without calling Shopify",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Concurrent rows in flight (default {MAX_WORKERS}); "
+        "raise it if the shop's API cost budget allows",
+    )
+    args = parser.parse_args()
+
+    endpoint, token = get_env()
+    rows = iter_product_rows(args.file_path, args.sheet)
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
+        while True:
+            batch = list(itertools.islice(rows, LOOKUP_BATCH_SIZE))
+            if not batch:
+                break
+
+            # One aliased lookup for the whole batch instead of one per row
+            handles = [h for h in (r["Handle"].strip() for r in batch) if h]
+            unique_handles = list(dict.fromkeys(handles))
+            try:
+                existing_by_handle = get_products_by_handles(unique_handles, endpoint, token)
+            except Exception as e:
+                # Don't discard the batch: retry each handle individually so
+                # one failed batched query can't sink 25 rows. Handles whose
+                # retry also fails stay out of the dict and their rows fail
+                # below instead of being mistaken for new products.
+                print(f"Batched lookup failed ({e}); retrying handles individually")
+                existing_by_handle = {}
+                for handle in unique_handles:
+                    try:
+                        existing_by_handle[handle] = get_product_by_handle(handle, endpoint, token)
+                    except Exception as lookup_err:
+                        print(f"Lookup failed for handle '{handle}': {lookup_err}")
+
+            # Stage the batch's images to the CDN before the mutations fire,
+            # so productSet ingests from Shopify's own storage. Only srcs the
+            # lookups show as missing get staged — on an idempotent re-run
+            # every image is already attached, and downloading/re-uploading
+            # it anyway would make re-runs cost far more than lookups.
+            if not args.dry_run:
+                srcs = []
+                for r in batch:
+                    src = r.get("Image Src", "").strip()
+                    handle = r["Handle"].strip()
+                    if not src or handle not in existing_by_handle:
+                        continue
+                    existing = existing_by_handle[handle]
+                    if existing is not None:
+                        norm = _norm_image_url(src)
+                        if (
+                            norm in collect_image_srcs(existing)
+                            or (existing["id"], norm) in _SEEN_IMAGES
+                        ):
+                            continue
+                    srcs.append(src)
+                stage_image_uploads(list(dict.fromkeys(srcs)), endpoint, token, ex)
+
+            # Different handles run concurrently, but rows sharing a handle
+            # run serially and re-read the freshest cached product between
+            # mutations — productSet is declarative, so acting on a stale
+            # pre-batch snapshot would restate (and thereby delete) whatever
+            # the previous row just wrote, and two rows creating the same
+            # new handle would race into duplicate products.
+            # Keyed by the absolute input-row index carried on each row, so
+            # failure messages line up with the skip messages printed during
+            # validation (which count invalid rows too)
+            groups: dict[str, list[tuple[int, dict]]] = {}
+            for row in batch:
+                groups.setdefault(row["Handle"].strip(), []).append((row["_row"], row))
+
+            def run_group(item, lookups=existing_by_handle):
+                handle, handle_rows = item
+                if handle not in lookups:
+                    for idx, _ in handle_rows:
+                        print(f"Row {idx} failed: could not look up handle '{handle}'")
+                    return
+                for idx, row in handle_rows:
+                    existing = _HANDLE_CACHE.get(handle, lookups[handle])
+                    _safe_process(idx, row, existing, endpoint, token, args.dry_run)
+
+            list(ex.map(run_group, groups.items()))
+
+
+if __name__ == "__main__":
+    main()
+